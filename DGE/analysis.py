@@ -4,7 +4,12 @@ Author: Xinyi Deng
 """
 
 
+import re
+import warnings
 from scipy.stats import ttest_ind, ranksums, f_oneway, kruskal
+from scipy.stats import t as t_dist, f as f_dist, norm
+from scipy.special import digamma, polygamma
+from scipy.linalg import solve_triangular
 import pandas as pd
 import numpy as np
 
@@ -49,6 +54,174 @@ def suggest_test_method(group_labels: pd.Series, verbose=True) -> str:
 
     return method
     
+def compute_gene_diagnostics(expression_df: pd.DataFrame, group_labels: pd.Series) -> pd.DataFrame:
+    """
+    Compute per-gene distribution diagnostics for all genes at once.
+
+    Args:
+        expression_df (pd.DataFrame): Log-transformed expression matrix (genes x samples).
+        group_labels (pd.Series): Series indicating group membership for each sample.
+
+    Returns:
+        pd.DataFrame: One row per gene with columns 'skew_z' (largest within-group
+        |adjusted skewness| divided by its standard error under normality), 'var_pval'
+        (Brown-Forsythe p-value for equal group variances) and 'zero_frac' (fraction of
+        zero values across all samples).
+    """
+    group_labels = group_labels.loc[expression_df.columns]  # align index
+    values = expression_df.values.astype(float)
+
+    skew_zs, dev_means, dev_ss, counts = [], [], [], []
+    # all-NaN groups and small groups are expected here; they fall back to neutral values below
+    with warnings.catch_warnings(), np.errstate(divide="ignore", invalid="ignore"):
+        warnings.simplefilter("ignore", RuntimeWarning)
+        for grp in group_labels.unique():
+            x = values[:, (group_labels == grp).values]
+            n = (~np.isnan(x)).sum(axis=1)
+
+            # adjusted Fisher-Pearson skewness G1 and its standard error (needs n >= 3)
+            centered = x - np.nanmean(x, axis=1, keepdims=True)
+            m2 = np.nanmean(centered ** 2, axis=1)
+            m3 = np.nanmean(centered ** 3, axis=1)
+            g1 = np.where(m2 > 0, m3 / m2 ** 1.5, 0.0)
+            skew = g1 * np.sqrt(n * (n - 1)) / (n - 2)
+            skew_se = np.sqrt(6 * n * (n - 1) / ((n - 2) * (n + 1) * (n + 3)))
+            skew_zs.append(np.where(n >= 3, np.abs(skew) / skew_se, 0.0))
+
+            # absolute deviations from the group median (Brown-Forsythe); a group needs
+            # at least 2 observed values to say anything about its variance
+            dev = np.abs(x - np.nanmedian(x, axis=1, keepdims=True))
+            dev_mean = np.nanmean(dev, axis=1)
+            dev_ss.append(np.where(n >= 2, np.nansum((dev - dev_mean[:, None]) ** 2, axis=1), 0.0))
+            dev_means.append(np.where(n >= 2, dev_mean, 0.0))
+            counts.append(np.where(n >= 2, n, 0))
+
+        skew_z = np.nan_to_num(np.column_stack(skew_zs)).max(axis=1)
+
+        # one-way ANOVA on the absolute deviations, over the groups with a variance estimate
+        dev_means, dev_ss, counts = np.column_stack(dev_means), np.column_stack(dev_ss), np.column_stack(counts)
+        k = (counts > 0).sum(axis=1)
+        total = counts.sum(axis=1)
+        grand_mean = (counts * dev_means).sum(axis=1) / total
+        between = (counts * (dev_means - grand_mean[:, None]) ** 2).sum(axis=1) / (k - 1)
+        within = dev_ss.sum(axis=1) / (total - k)
+        f_stat = np.where(within > 0, between / within, np.where(between > 0, np.inf, 0.0))
+        var_pval = np.where((k >= 2) & (total > k), f_dist.sf(f_stat, k - 1, total - k), 1.0)
+
+    return pd.DataFrame({
+        "skew_z": skew_z,
+        "var_pval": var_pval,
+        "zero_frac": (values == 0).mean(axis=1),
+    }, index=expression_df.index)
+
+def suggest_test_method_per_gene(expression_df: pd.DataFrame, group_labels: pd.Series, skew_alpha=0.01,
+                                 var_alpha=0.01, zero_frac_thresh=0.3, min_group_size=20, verbose=True) -> pd.Series:
+    """
+    Suggest a statistical test method for each gene based on its data distribution.
+
+    A gene is routed to the rank-based test when it is zero-inflated, when its skewness is
+    significant (two-sided normal test on skew_z, Bonferroni-corrected over groups) and the groups are too small
+    (<min_group_size) to rely on the central limit theorem, or (for >2 groups only, since
+    the 2-group t-test is Welch's) when the Brown-Forsythe test rejects equal variances.
+
+    Args:
+        expression_df (pd.DataFrame): Log-transformed expression matrix (genes x samples).
+        group_labels (pd.Series): Series indicating group membership for each sample.
+        skew_alpha (float): Significance level at which a gene counts as skewed.
+        var_alpha (float): Significance level at which group variances count as unequal.
+        zero_frac_thresh (float): Fraction of zero values above which a gene counts as zero-inflated.
+        min_group_size (int): Group size from which skewness is tolerated by the parametric test.
+        verbose (bool): If True, print how many genes were routed to each test.
+
+    Returns:
+        pd.Series: Suggested method per gene ('ttest', 'wilcoxon', 'anova', or 'kruskal').
+    """
+    group_labels = group_labels.loc[expression_df.columns]  # align index
+    num_groups = group_labels.nunique()
+    if num_groups == 2:
+        parametric, nonparametric = "ttest", "wilcoxon"
+    elif num_groups > 2:
+        parametric, nonparametric = "anova", "kruskal"
+    else:
+        raise ValueError("Invalid number of groups for comparison.")
+
+    diagnostics = compute_gene_diagnostics(expression_df, group_labels)
+    small_groups = group_labels.value_counts().min() < min_group_size
+
+    use_rank_test = diagnostics["zero_frac"] > zero_frac_thresh
+    if small_groups:
+        # skew_z is the largest of num_groups group statistics, so Bonferroni-correct the cutoff
+        use_rank_test |= diagnostics["skew_z"] > norm.isf(skew_alpha / (2 * num_groups))
+    if num_groups > 2:
+        use_rank_test |= diagnostics["var_pval"] < var_alpha
+
+    methods = pd.Series(np.where(use_rank_test, nonparametric, parametric), index=expression_df.index, name="method")
+
+    if verbose:
+        counts = methods.value_counts()
+        summary = ", ".join(f"{m.upper()}: {counts.get(m, 0)}" for m in (parametric, nonparametric))
+        print(f"✅ Adaptive per-gene methods → {summary}")
+
+    return methods
+
+def _run_test(method: str, groups: list):
+    """
+    Run one test on every row of the per-group matrices, vectorized along axis 1.
+
+    Rows without missing values are tested in a single call; only rows with NaN
+    go through scipy's slower nan_policy='omit' path.
+
+    Returns:
+        np.ndarray: p-value per row.
+    """
+    tests = {"ttest": lambda *g, **kw: ttest_ind(*g, equal_var=False, **kw),
+             "wilcoxon": ranksums, "anova": f_oneway, "kruskal": kruskal}
+    has_nan = np.any([np.isnan(g).any(axis=1) for g in groups], axis=0)
+    pvals = np.full(len(has_nan), np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if (~has_nan).any():
+            pvals[~has_nan] = tests[method](*[g[~has_nan] for g in groups], axis=1).pvalue
+        if has_nan.any():
+            pvals[has_nan] = tests[method](*[g[has_nan] for g in groups], axis=1, nan_policy="omit").pvalue
+    return pvals
+
+def _test_genes(expression_df: pd.DataFrame, group_labels: pd.Series, unique_groups, method: str) -> pd.DataFrame:
+    """
+    Run one statistical test on all genes of the expression matrix at once.
+
+    Returns:
+        pd.DataFrame: 'log2FC', 'pval' and 'method' for genes that could be tested.
+    """
+    num_groups = len(unique_groups)
+    if num_groups == 2 and method not in ("ttest", "wilcoxon"):
+        raise ValueError("Unsupported 2-group test. Use 'ttest' or 'wilcoxon'.")
+    if num_groups > 2 and method not in ("anova", "kruskal"):
+        raise ValueError("Unsupported multi-group test. Use 'anova' or 'kruskal'.")
+
+    values = expression_df.values.astype(float)
+    groups = [values[:, (group_labels == grp).values] for grp in unique_groups]
+
+    # skip genes with an empty group
+    keep = np.all([(~np.isnan(g)).any(axis=1) for g in groups], axis=0)
+    if num_groups > 2:
+        # skip if all values are the same (kruskal/f_oneway will crash)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            keep &= np.nanmax(values, axis=1) != np.nanmin(values, axis=1)
+    groups = [g[keep] for g in groups]
+
+    if num_groups == 2:
+        g1, g2 = groups
+        log2fc = np.log2(np.nanmean(g2, axis=1) + 1) - np.log2(np.nanmean(g1, axis=1) + 1)
+    else:
+        log2fc = np.nan  # no log2FC for multi-group
+
+    pvals = _run_test(method, groups) if keep.any() else np.array([])
+    res_df = pd.DataFrame({"log2FC": log2fc, "pval": pvals, "method": method},
+                          index=expression_df.index[keep])
+    res_df.index.name = "gene"
+    return res_df
+
 def differential_expression(expression_df: pd.DataFrame, group_labels: pd.Series, method="ttest", log2fc_thresh=1, pval_thresh=0.05):
     """
     Perform differential expression analysis using appropriate statistical test.
@@ -56,66 +229,250 @@ def differential_expression(expression_df: pd.DataFrame, group_labels: pd.Series
     Args:
         expression_df (pd.DataFrame): Log-transformed expression matrix (genes x samples).
         group_labels (pd.Series): Series indicating group membership for each sample.
-        method (str): 'ttest', 'wilcoxon' (for 2 groups) or 'anova', 'kruskal' (for >2 groups).
+        method (str): 'ttest', 'wilcoxon' (for 2 groups) or 'anova', 'kruskal' (for >2 groups),
+            or 'adaptive' to choose the test per gene with suggest_test_method_per_gene.
         log2fc_thresh (float): Absolute log2FC threshold for filtering (only used for 2-group).
         pval_thresh (float): Adjusted p-value threshold.
 
     Returns:
-        pd.DataFrame: Differential expression results.
+        pd.DataFrame: Differential expression results, with the test used for each gene in 'method'.
     """
     group_labels = group_labels.loc[expression_df.columns]  # align index
     unique_groups = group_labels.unique()
     num_groups = len(unique_groups)
 
-    results = []
+    if method == "adaptive":
+        gene_methods = suggest_test_method_per_gene(expression_df, group_labels)
+        # run each test once on its batch of genes, then restore the original gene order
+        batches = [_test_genes(expression_df.loc[genes], group_labels, unique_groups, batch_method)
+                   for batch_method, genes in gene_methods.groupby(gene_methods).groups.items()]
+        res_df = pd.concat(batches)
+        res_df = res_df.reindex(expression_df.index[expression_df.index.isin(res_df.index)])
+        res_df.index.name = "gene"
+    else:
+        res_df = _test_genes(expression_df, group_labels, unique_groups, method)
 
-    for gene in expression_df.index:
-        values = [expression_df.loc[gene, group_labels == grp].values.flatten() for grp in unique_groups]
+    res_df["adj_pval"] = res_df["pval"] * len(res_df)
 
-        if num_groups == 2:
-            g1, g2 = values
-    
-            # remove NaN
-            g1 = g1[~np.isnan(g1)]
-            g2 = g2[~np.isnan(g2)]
-            if len(g1) == 0 or len(g2) == 0:
-                continue
-            log2fc = np.log2(g2.mean() + 1) - np.log2(g1.mean() + 1)
-
-            if method == "ttest":
-                stat, pval = ttest_ind(g1, g2, equal_var=False)
-            elif method == "wilcoxon":
-                stat, pval = ranksums(g1, g2)
-            else:
-                raise ValueError("Unsupported 2-group test. Use 'ttest' or 'wilcoxon'.")
-            results.append((gene, log2fc, pval))
+    if num_groups == 2:
+        sig_df = res_df[(res_df["adj_pval"] < pval_thresh) & (abs(res_df["log2FC"]) > log2fc_thresh)]
+    else:
+        sig_df = res_df[res_df["adj_pval"] < pval_thresh]
+
+    return sig_df.sort_values("adj_pval"), res_df
+
+def _parse_formula_terms(formula: str) -> list:
+    """
+    Split a formula such as '~ fusion + batch' into its metadata column names.
+    """
+    terms = [term.strip() for term in formula.replace("~", "").split("+")]
+    terms = [term for term in terms if term and term != "1"]
+    # only a '0' term or a trailing '- 1' drops the intercept; hyphens inside column names are fine
+    if "0" in terms or any(re.search(r"(^|\s)-\s*1$", term) for term in terms):
+        raise ValueError("Formulas without an intercept ('0 +' or '- 1') are not supported.")
+    if not terms:
+        raise ValueError("Formula must contain at least one metadata column.")
+    return terms
+
+def build_design_matrix(sample_info: pd.DataFrame, formula: str) -> pd.DataFrame:
+    """
+    Build a design matrix from sample metadata and a formula such as '~ fusion + batch + sex + age'.
+
+    Every design includes an intercept. Numeric columns enter the model as-is; other
+    columns are treatment-coded against their first level (the first category for
+    categorical columns, otherwise the first value in sorted order).
+
+    Args:
+        sample_info (pd.DataFrame): Sample metadata indexed by sample name.
+        formula (str): Right-hand side formula with terms joined by '+'.
 
+    Returns:
+        pd.DataFrame: Design matrix (samples x coefficients).
+    """
+    terms = _parse_formula_terms(formula)
+
+    design = pd.DataFrame({"Intercept": 1.0}, index=sample_info.index)
+    for term in terms:
+        if term not in sample_info.columns:
+            raise ValueError(f"Formula term '{term}' is not a column of sample_info.")
+        column = sample_info[term]
+        if column.isna().any():
+            raise ValueError(f"Column '{term}' contains missing values.")
+        if pd.api.types.is_numeric_dtype(column) and not pd.api.types.is_bool_dtype(column):
+            design[term] = column.astype(float)
         else:
-            values = [v[~np.isnan(v)] for v in values]
-
-            # skip any empty group
-            if any(len(v) == 0 for v in values):
-                continue
-
-            # skip if all values are the same (kruskal/f_oneway will crash)
-            all_values = np.concatenate(values)
-            if np.all(all_values == all_values[0]):
-                continue
-            if method == "anova":
-                stat, pval = f_oneway(*values)
-            elif method == "kruskal":
-                stat, pval = kruskal(*values)
+            if isinstance(column.dtype, pd.CategoricalDtype):
+                levels = [lvl for lvl in column.cat.categories if (column == lvl).any()]
             else:
-                raise ValueError("Unsupported multi-group test. Use 'anova' or 'kruskal'.")
-            results.append((gene, np.nan, pval))  # no log2FC for multi-group
+                levels = sorted(column.unique(), key=str)
+            for level in levels[1:]:
+                design[f"{term}[T.{level}]"] = (column == level).astype(float)
+
+    return design
+
+def _trigamma_inverse(x: float) -> float:
+    """
+    Solve trigamma(y) = x for y with Newton's method (as in limma).
+    """
+    if x > 1e7:
+        return 1 / np.sqrt(x)
+    if x < 1e-6:
+        return 1 / x
+    y = 0.5 + 1 / x
+    for _ in range(50):
+        tri = polygamma(1, y)
+        dif = tri * (1 - tri / x) / polygamma(2, y)
+        y += dif
+        if -dif / y < 1e-8:
+            break
+    return y
+
+def _squeeze_var(s2: np.ndarray, df: float) -> tuple:
+    """
+    Empirical-Bayes shrinkage of gene-wise variances towards a common prior.
+
+    The prior (scaled inverse chi-square with df0 degrees of freedom and scale s0^2)
+    is estimated by moment matching on the log variances, as in limma's fitFDist.
+
+    Returns:
+        tuple: (posterior variances, prior df0, prior variance s0^2).
+    """
+    z = np.log(s2[s2 > 0])
+    if len(z) < 2:
+        raise ValueError("Need at least two genes with non-zero variance for variance shrinkage.")
+    e = z - digamma(df / 2) + np.log(df / 2)
+    e_mean = e.mean()
+    e_var = e.var(ddof=1) - polygamma(1, df / 2)
+
+    if e_var > 0:
+        df0 = 2 * _trigamma_inverse(e_var)
+        s0_2 = np.exp(e_mean + digamma(df0 / 2) - np.log(df0 / 2))
+        s2_post = (df0 * s0_2 + df * s2) / (df0 + df)
+    else:
+        df0 = np.inf
+        s0_2 = np.exp(e_mean)
+        s2_post = np.full_like(s2, s0_2)
+
+    return s2_post, df0, s0_2
+
+def _contrast_matrix(coef_names: list, contrast) -> np.ndarray:
+    """
+    Turn a contrast specification into a (coefficients x contrasts) weight matrix.
+
+    A contrast is a coefficient name or a dict of {coefficient name: weight};
+    a list (or any other sequence) of them asks for a joint F-test.
+    """
+    contrasts = [contrast] if isinstance(contrast, (str, dict)) else list(contrast)
+    if not contrasts:
+        raise ValueError("At least one contrast is required.")
+    matrix = np.zeros((len(coef_names), len(contrasts)))
+    for j, con in enumerate(contrasts):
+        if not isinstance(con, (str, dict)):
+            raise ValueError(f"Unsupported contrast {con!r}. Use a coefficient name or a {{coefficient: weight}} dict.")
+        weights = {con: 1.0} if isinstance(con, str) else con
+        for name, weight in weights.items():
+            if name not in coef_names:
+                raise ValueError(f"Unknown coefficient '{name}'. Available: {', '.join(coef_names)}.")
+            matrix[coef_names.index(name), j] = weight
+    return matrix
+
+def linear_model_de(expression_df: pd.DataFrame, sample_info: pd.DataFrame, formula: str, contrast=None,
+                    log2fc_thresh=1, pval_thresh=0.05):
+    """
+    Perform covariate-adjusted differential expression with a linear model fitted to all genes at once.
 
-    res_df = pd.DataFrame(results, columns=["gene", "log2FC", "pval"]).set_index("gene")
+    The design matrix is QR-factorized once and shared across genes, gene-wise residual
+    variances are shrunk with empirical Bayes, and moderated t (one contrast) or
+    moderated F (several contrasts) statistics are computed, as in limma.
+
+    Samples without any measurement are dropped first. Genes with any remaining missing
+    value cannot share the factorization; they are excluded from the results and their
+    number is printed. Linearly dependent contrasts are reduced to their independent
+    part for the moderated F-test.
+
+    Args:
+        expression_df (pd.DataFrame): Log-transformed expression matrix (genes x samples).
+        sample_info (pd.DataFrame): Sample metadata indexed by sample name.
+        formula (str): Design formula, e.g. '~ fusion + batch + sex + age'.
+        contrast (str, dict or list): Coefficient name, {coefficient: weight} dict, or a list or tuple
+            of these for a joint F-test. Defaults to all coefficients of the first formula term.
+        log2fc_thresh (float): Absolute log2FC threshold for filtering (only used for a single contrast).
+        pval_thresh (float): Adjusted p-value threshold.
+
+    Returns:
+        pd.DataFrame: Differential expression results.
+    """
+    # samples without any measurement (e.g. a failed library) would otherwise remove every gene
+    empty_samples = expression_df.columns[expression_df.isna().all(axis=0)]
+    if len(empty_samples) > 0:
+        print(f"⚠️ Excluded {len(empty_samples)} samples without measurements: {', '.join(map(str, empty_samples))}.")
+        expression_df = expression_df.drop(columns=empty_samples)
+
+    # genes with missing values cannot share the factorization
+    num_missing = expression_df.isna().any(axis=1).sum()
+    if num_missing > 0:
+        print(f"⚠️ Excluded {num_missing} genes with missing values from the linear model.")
+        expression_df = expression_df.dropna()
+    if expression_df.empty:
+        raise ValueError("No genes without missing values remain for the linear model.")
+
+    design = build_design_matrix(sample_info.loc[expression_df.columns], formula)
+    coef_names = design.columns.tolist()
+    if contrast is None:
+        first_term = _parse_formula_terms(formula)[0]
+        contrast = [name for name in coef_names if name == first_term or name.startswith(f"{first_term}[T.")]
+    contrast_mat = _contrast_matrix(coef_names, contrast)
+
+    X = design.values
+    Y = expression_df.values.astype(float)
+    n_samples, n_coefs = X.shape
+    df_res = n_samples - n_coefs
+    if df_res <= 0:
+        raise ValueError("Not enough samples to estimate residual variance for this design.")
+
+    Q, R = np.linalg.qr(X)
+    if np.linalg.matrix_rank(R) < n_coefs:
+        raise ValueError("Design matrix is not full rank. Check for confounded covariates.")
+    coefs = solve_triangular(R, Q.T @ Y.T).T  # genes x coefficients
+    residuals = Y - coefs @ X.T
+    s2 = (residuals ** 2).sum(axis=1) / df_res
+
+    R_inv = solve_triangular(R, np.eye(n_coefs))
+    unscaled_cov = contrast_mat.T @ (R_inv @ R_inv.T) @ contrast_mat
+
+    s2_post, df0, _ = _squeeze_var(s2, df_res)
+    df_total = min(df_res + df0, df_res * len(s2))
+
+    estimates = coefs @ contrast_mat
+    std_unscaled = np.sqrt(np.diag(unscaled_cov))
+    t_stats = estimates / (np.sqrt(s2_post)[:, None] * std_unscaled)
+
+    num_contrasts = contrast_mat.shape[1]
+    if num_contrasts == 1:
+        stats = t_stats[:, 0]
+        pvals = 2 * t_dist.sf(np.abs(stats), df_total)
+        res_df = pd.DataFrame({"log2FC": estimates[:, 0], "t": stats, "pval": pvals}, index=expression_df.index)
+    else:
+        # as in limma's classifyTestsF: project onto the independent directions of the
+        # contrast correlation matrix, so dependent contrasts only reduce the numerator df
+        cor = unscaled_cov / np.outer(std_unscaled, std_unscaled)
+        eigvals, eigvecs = np.linalg.eigh(cor)
+        eigvals, eigvecs = eigvals[::-1], eigvecs[:, ::-1]
+        rank = int((eigvals / eigvals[0] > 1e-8).sum())
+        if rank < num_contrasts:
+            print(f"⚠️ Contrasts are linearly dependent; testing {rank} independent contrasts.")
+        projection = eigvecs[:, :rank] / np.sqrt(eigvals[:rank])
+        stats = ((t_stats @ projection) ** 2).sum(axis=1) / rank
+        pvals = f_dist.sf(stats, rank, df_total)
+        res_df = pd.DataFrame({"log2FC": np.nan, "F": stats, "pval": pvals}, index=expression_df.index)
+
+    res_df.index.name = "gene"
+    res_df["method"] = "linear_model"
     res_df["adj_pval"] = res_df["pval"] * len(res_df)
 
-    if num_groups == 2:
+    if num_contrasts == 1:
         sig_df = res_df[(res_df["adj_pval"] < pval_thresh) & (abs(res_df["log2FC"]) > log2fc_thresh)]
     else:
         sig_df = res_df[res_df["adj_pval"] < pval_thresh]
 
     return sig_df.sort_values("adj_pval"), res_df
-
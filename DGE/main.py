@@ -15,7 +15,7 @@ from .data_processing  import (
     compute_z_scores,
     filter_low_variance_genes,
 )
-from .analysis import differential_expression, suggest_test_method
+from .analysis import differential_expression, suggest_test_method, linear_model_de
 from .visualization import (
     plot_heatmap,
     plot_volcano,
@@ -30,7 +30,9 @@ def main():
     parser.add_argument("--sample_info", required=True, help="Path to sample metadata CSV file.")
     parser.add_argument("--group_col", default="integration", help="Column in metadata to group by (e.g., integration, fusion).")
     parser.add_argument("--data_type", choices=["raw", "normalized"], default="raw", help="Specify whether expression data is raw counts or already normalized.")
-    parser.add_argument("--method", default=None, help="Statistical test to use. Options: ttest, wilcoxon, anova, kruskal. Leave blank to auto-select.")
+    parser.add_argument("--method", default=None, help="Statistical test to use. Options: ttest, wilcoxon, anova, kruskal, adaptive (per-gene choice). Leave blank to auto-select.")
+    parser.add_argument("--formula", default=None, help="Design formula for covariate-adjusted linear-model DE (e.g., '~ fusion + batch + sex + age'). Overrides --method.")
+    parser.add_argument("--contrast", default=None, help="Comma-separated design coefficients to test with --formula (e.g., 'fusion[T.yes]'). Defaults to the first formula term.")
 
     args = parser.parse_args()
     
@@ -57,11 +59,15 @@ def main():
     
     # === Differential expression analysis ===
     group_labels = sample_info[args.group_col]
-    if args.method is None:
-        method = suggest_test_method(group_labels)
+    if args.formula is not None:
+        contrast = args.contrast.split(",") if args.contrast else None
+        deg_df, full_df = linear_model_de(log_expr, sample_info, args.formula, contrast=contrast)
     else:
-        method = args.method
-    deg_df, full_df = differential_expression(log_expr, group_labels, method=method)
+        if args.method is None:
+            method = suggest_test_method(group_labels)
+        else:
+            method = args.method
+        deg_df, full_df = differential_expression(log_expr, group_labels, method=method)
     
     # === Save DEG result table ===
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
@@ -1,6 +1,8 @@
 import unittest
 from unittest.mock import patch, MagicMock
 import pandas as pd
+import numpy as np
+from DGE.analysis import differential_expression, suggest_test_method_per_gene, build_design_matrix, linear_model_de
 
 class TestRunDESeq2(unittest.TestCase):
     
@@ -48,5 +50,129 @@ class TestRunDESeq2(unittest.TestCase):
         self.assertEqual(result_df['log2FoldChange'][0], 1.2)
         self.assertEqual(result_df['pvalue'][1], 0.05)
 
+class TestAdaptiveTestSelection(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        samples = [f"S{i}" for i in range(12)]
+        self.group_labels = pd.Series(["A"] * 6 + ["B"] * 6, index=samples)
+        normal = rng.normal(5, 1, size=(1, 12))
+        well_behaved = np.array([[4, 5, 6, 4, 5, 6, 5, 6, 7, 5, 6, 7]], dtype=float)
+        skewed = np.array([[1, 1, 1, 1, 1, 9, 2, 2, 2, 2, 2, 9]], dtype=float)
+        zero_inflated = np.array([[0, 0, 0, 0, 3, 0, 0, 0, 6, 0, 0, 7]], dtype=float)
+        self.expression_df = pd.DataFrame(
+            np.vstack([normal, well_behaved, skewed, zero_inflated]),
+            index=["Gene1", "Gene2", "Gene3", "Gene4"],
+            columns=samples,
+        )
+
+    def test_suggest_test_method_per_gene(self):
+        methods = suggest_test_method_per_gene(self.expression_df, self.group_labels, verbose=False)
+        self.assertEqual(methods["Gene2"], "ttest")
+        self.assertEqual(methods["Gene3"], "wilcoxon")
+        self.assertEqual(methods["Gene4"], "wilcoxon")
+
+    def test_suggest_test_method_per_gene_unequal_variance(self):
+        samples = [f"S{i}" for i in range(24)]
+        group_labels = pd.Series(np.repeat(["A", "B", "C"], 8), index=samples)
+        tight = [4.8, 4.9, 4.9, 5.0, 5.0, 5.1, 5.1, 5.2]
+        spread = [1.0, 2.0, 3.0, 4.0, 6.0, 7.0, 8.0, 9.0]
+        expression_df = pd.DataFrame([
+            tight + [x + 1 for x in tight] + spread,
+            spread + [x + 1 for x in spread] + [x + 2 for x in spread],
+        ], index=["Gene1", "Gene2"], columns=samples)
+        methods = suggest_test_method_per_gene(expression_df, group_labels, verbose=False)
+        self.assertEqual(methods["Gene1"], "kruskal")
+        self.assertEqual(methods["Gene2"], "anova")
+
+    def test_suggest_test_method_per_gene_null_data(self):
+        rng = np.random.default_rng(2)
+        samples = [f"S{i}" for i in range(32)]
+        group_labels = pd.Series(np.repeat(["A", "B", "C", "D"], 8), index=samples)
+        expression_df = pd.DataFrame(rng.normal(5, 1, size=(2000, 32)), columns=samples)
+        methods = suggest_test_method_per_gene(expression_df, group_labels, verbose=False)
+        self.assertLess((methods == "kruskal").mean(), 0.05)
+
+    def test_adaptive_differential_expression_reports_method(self):
+        _, full_df = differential_expression(self.expression_df, self.group_labels, method="adaptive")
+        self.assertIn("method", full_df.columns)
+        self.assertEqual(full_df.index.tolist(), self.expression_df.index.tolist())
+        self.assertEqual(full_df.index.name, "gene")
+        self.assertEqual(full_df.loc["Gene4", "method"], "wilcoxon")
+
+
+class TestLinearModelDE(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        samples = [f"S{i}" for i in range(16)]
+        self.sample_info = pd.DataFrame({
+            "fusion": ["no", "yes"] * 8,
+            "batch": ["b1"] * 8 + ["b2"] * 8,
+            "age": rng.uniform(30, 70, size=16),
+        }, index=samples)
+        values = rng.normal(5, 0.3, size=(50, 16))
+        values[:, 8:] += 2  # batch effect on every gene
+        values[0, self.sample_info["fusion"] == "yes"] += 3  # true DE gene
+        self.expression_df = pd.DataFrame(values, index=[f"Gene{i}" for i in range(50)], columns=samples)
+
+    def test_build_design_matrix(self):
+        design = build_design_matrix(self.sample_info, "~ fusion + batch + age")
+        self.assertEqual(design.columns.tolist(), ["Intercept", "fusion[T.yes]", "batch[T.b2]", "age"])
+        self.assertEqual(design.shape, (16, 4))
+
+    def test_linear_model_de_moderated_t(self):
+        deg_df, full_df = linear_model_de(self.expression_df, self.sample_info, "~ fusion + batch + age")
+        self.assertEqual(len(full_df), 50)
+        self.assertIn("t", full_df.columns)
+        self.assertEqual(deg_df.index[0], "Gene0")
+        self.assertAlmostEqual(full_df.loc["Gene0", "log2FC"], 3, delta=0.5)
+
+    def test_linear_model_de_moderated_f(self):
+        _, full_df = linear_model_de(self.expression_df, self.sample_info, "~ fusion + batch + age",
+                                     contrast=["fusion[T.yes]", "batch[T.b2]"])
+        self.assertIn("F", full_df.columns)
+        self.assertTrue((full_df["pval"] < 0.01).all())
+
+    def test_linear_model_de_tuple_contrast(self):
+        _, full_df = linear_model_de(self.expression_df, self.sample_info, "~ fusion + batch + age",
+                                     contrast=("fusion[T.yes]",))
+        self.assertIn("t", full_df.columns)
+        with self.assertRaises(ValueError):
+            linear_model_de(self.expression_df, self.sample_info, "~ fusion + batch", contrast=[1.0])
+
+    def test_linear_model_de_missing_values_and_formula(self):
+        expression_df = self.expression_df.copy()
+        expression_df.iloc[1, 0] = np.nan
+        with patch("builtins.print") as mock_print:
+            _, full_df = linear_model_de(expression_df, self.sample_info, "~ fusion + batch")
+        self.assertNotIn("Gene1", full_df.index)
+        self.assertIn("Excluded 1 genes", mock_print.call_args[0][0])
+        with self.assertRaises(ValueError):
+            linear_model_de(self.expression_df, self.sample_info, "~ 0 + fusion")
+        with self.assertRaises(ValueError):
+            linear_model_de(self.expression_df, self.sample_info, "~ fusion - 1")
+
+    def test_linear_model_de_failed_sample_and_hyphenated_column(self):
+        expression_df = self.expression_df.copy()
+        expression_df["S0"] = np.nan
+        sample_info = self.sample_info.rename(columns={"batch": "seq-batch"})
+        _, full_df = linear_model_de(expression_df, sample_info, "~ fusion + seq-batch")
+        self.assertEqual(len(full_df), 50)
+        patchy_df = self.expression_df.copy()
+        for i in range(len(patchy_df)):
+            patchy_df.iloc[i, i % 16] = np.nan
+        with self.assertRaisesRegex(ValueError, "No genes without missing values"):
+            linear_model_de(patchy_df, sample_info, "~ fusion")
+
+    def test_linear_model_de_dependent_contrasts(self):
+        formula = "~ fusion + batch + age"
+        _, t_df = linear_model_de(self.expression_df, self.sample_info, formula, contrast="fusion[T.yes]")
+        _, f_df = linear_model_de(self.expression_df, self.sample_info, formula,
+                                  contrast=["fusion[T.yes]", "fusion[T.yes]"])
+        np.testing.assert_allclose(f_df["F"], t_df["t"] ** 2)
+        np.testing.assert_allclose(f_df["pval"], t_df["pval"])
+
+
 if __name__ == '__main__':
     unittest.main()